@@ -5,13 +5,16 @@ Supports Pi Camera Module 3 (picamera2) and USB/webcam (OpenCV).
 """
 
 import logging
+import queue
 import time
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
 # Try picamera2 first (for Pi Camera Module 3)
 try:
-    from picamera2 import Picamera2
+    from picamera2 import MappedArray, Picamera2
     PICAMERA2_AVAILABLE = True
 except ImportError:
     PICAMERA2_AVAILABLE = False
@@ -21,35 +24,116 @@ except ImportError:
 import cv2
 
 
+class FramePool:
+    """
+    Reusable frame buffers handed out by ownership.
+
+    A buffer from acquire() is only handed out again after its holder
+    gives it back with release(), so frames can be passed between threads
+    without being overwritten underneath the consumer.
+    """
+
+    def __init__(self, shape: tuple, dtype=np.uint8, size: int = 4):
+        self.shape = shape
+        self.dtype = dtype
+        self._free = queue.SimpleQueue()
+        for _ in range(size):
+            self._free.put(np.empty(shape, dtype))
+
+    def acquire(self):
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            # Every buffer is still held downstream; grow rather than overwrite
+            return np.empty(self.shape, self.dtype)
+
+    def release(self, frame):
+        if frame.shape == self.shape and frame.dtype == self.dtype:
+            self._free.put(frame)
+
+
 class PiCamera:
     """Pi Camera Module 3 using picamera2."""
 
-    def __init__(self, width: int = 640, height: int = 480, fps: int = 30):
+    def __init__(self, width: int = 640, height: int = 480, fps: int = 30,
+                 grayscale: bool = False, roi: list = None):
         self.width = width
         self.height = height
         self.fps = fps
+        self.grayscale = grayscale
+        self.roi = roi
+        # With an ROI the ISP crops on the sensor and outputs only the ROI
+        self.size = (roi[2], roi[3]) if roi else (width, height)
         self.camera = None
+        self._pool = None
 
     def start(self):
         self.camera = Picamera2()
+        # picamera2's "RGB888" is laid out B, G, R in memory, which is
+        # already OpenCV's native BGR order - no per-frame swap needed.
+        # YUV420 leads with a full-resolution Y plane, which is grayscale.
+        fmt = "YUV420" if self.grayscale else "RGB888"
+        controls = {"FrameRate": self.fps}
+        if self.roi:
+            controls["ScalerCrop"] = self._scaler_crop()
         config = self.camera.create_preview_configuration(
-            main={"size": (self.width, self.height), "format": "RGB888"},
-            controls={"FrameRate": self.fps}
+            main={"size": self.size, "format": fmt},
+            controls=controls
         )
         self.camera.configure(config)
+        # libcamera may adjust the requested size (e.g. odd ROI widths in
+        # YUV420); frames must be sized from what was actually configured
+        self.size = tuple(self.camera.camera_config["main"]["size"])
+        width, height = self.size
+        self._pool = FramePool((height, width) if self.grayscale else (height, width, 3))
         self.camera.start()
-        logger.info(f"Pi Camera started at {self.width}x{self.height} @ {self.fps}fps")
+        logger.info(f"Pi Camera started at {width}x{height} @ {self.fps}fps")
         time.sleep(2)  # Warm up
 
     def read(self):
-        """Returns (success, frame) like OpenCV."""
+        """
+        Returns (success, frame) like OpenCV.
+        Pass the frame to recycle() once done with it.
+        """
         if self.camera is None:
             return False, None
-        frame = self.camera.capture_array()
-        # Convert RGB to BGR for OpenCV compatibility
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+
+        # Copy straight out of the mapped DMA buffer into a pooled array and
+        # hand the request back to libcamera at once, since it only has a
+        # few buffers and holding them stalls capture
+        request = self.camera.capture_request()
+        try:
+            with MappedArray(request, "main") as mapped:
+                frame = self._pool.acquire()
+                # For YUV420 this keeps only the Y (luma) plane; in both
+                # formats it drops any stride padding
+                width, height = self.size
+                np.copyto(frame, mapped.array[:height, :width])
+        finally:
+            request.release()
         return True, frame
 
+    def recycle(self, frame):
+        """Return a frame from read() to the buffer pool."""
+        if self._pool is not None:
+            self._pool.release(frame)
+
+    def _scaler_crop(self):
+        """Map the ROI from frame pixels to a sensor ScalerCrop rectangle."""
+        # The uncropped frame is the largest centred sensor window with the
+        # frame's aspect ratio, so scale the ROI into that window.
+        max_x, max_y, max_w, max_h = self.camera.camera_properties["ScalerCropMaximum"]
+        scale = min(max_w / self.width, max_h / self.height)
+        offset_x = max_x + (max_w - self.width * scale) / 2
+        offset_y = max_y + (max_h - self.height * scale) / 2
+        x, y, w, h = self.roi
+        return (
+            int(offset_x + x * scale),
+            int(offset_y + y * scale),
+            int(w * scale),
+            int(h * scale),
+        )
+
     def release(self):
         if self.camera:
             self.camera.stop()
@@ -60,27 +144,85 @@ class PiCamera:
 class USBCamera:
     """USB/Webcam using OpenCV."""
 
-    def __init__(self, index: int = 0, width: int = 640, height: int = 480, fps: int = 30):
+    def __init__(self, index: int = 0, width: int = 640, height: int = 480, fps: int = 30,
+                 grayscale: bool = False, roi: list = None):
         self.index = index
         self.width = width
         self.height = height
         self.fps = fps
+        self.grayscale = grayscale
+        self.roi = roi
+        self._roi_slice = None
+        if roi:
+            x, y, w, h = roi
+            self._roi_slice = (slice(y, y + h), slice(x, x + w))
         self.camera = None
+        self._pool = None
 
     def start(self):
         self.camera = cv2.VideoCapture(self.index)
+        # Compressed transfer instead of raw YUYV over USB
+        self.camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
         self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
         self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
         self.camera.set(cv2.CAP_PROP_FPS, self.fps)
+        # Only keep the newest frame queued so reads are never stale
+        self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        mjpg = int(self.camera.get(cv2.CAP_PROP_FOURCC)) == cv2.VideoWriter_fourcc(*"MJPG")
+        if self.grayscale and mjpg:
+            # Hand back raw MJPG payloads so they can be decoded straight to gray.
+            # Not for other formats: V4L2 would then return raw YUYV etc.
+            self.camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
 
         if not self.camera.isOpened():
             raise RuntimeError("Failed to open USB camera")
 
+        # Decode BGR frames into pooled buffers. Grayscale frames come from
+        # imdecode, which always allocates, so they are not pooled.
+        if not self.grayscale:
+            width = int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH)) or self.width
+            height = int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT)) or self.height
+            self._pool = FramePool((height, width, 3))
+
         logger.info(f"USB Camera started at {self.width}x{self.height}")
         time.sleep(2)
 
     def read(self):
-        return self.camera.read()
+        """
+        Returns (success, frame) like OpenCV.
+        Pass the frame to recycle() once done with it.
+        """
+        if self._pool is None:
+            ret, frame = self.camera.read()
+        else:
+            buffer = self._pool.acquire()
+            ret, frame = self.camera.read(buffer)
+            if not ret:
+                self._pool.release(buffer)
+        if not ret:
+            return ret, frame
+        if self.grayscale:
+            if frame.ndim == 2 and frame.shape[0] == 1:
+                # Undecoded MJPG bytes
+                frame = cv2.imdecode(frame, cv2.IMREAD_GRAYSCALE)
+                if frame is None:
+                    return False, None
+            elif frame.ndim == 3 and frame.shape[2] == 2:
+                # Raw packed YUYV; the luma is every other byte
+                frame = cv2.cvtColor(frame, cv2.COLOR_YUV2GRAY_YUYV)
+            elif frame.ndim == 3:
+                # Decoded to BGR (non-MJPG camera, or CONVERT_RGB ignored)
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self._roi_slice:
+            # No sensor-side crop over UVC; slicing is a view, not a copy
+            frame = frame[self._roi_slice]
+        return True, frame
+
+    def recycle(self, frame):
+        """Return a frame from read() to the buffer pool."""
+        if self._pool is not None:
+            # ROI frames are views; the pooled buffer is their base
+            self._pool.release(frame if frame.base is None else frame.base)
 
     def release(self):
         if self.camera:
@@ -105,15 +247,19 @@ def create_camera(config: dict):
     width = config.get("frame_width", 640)
     height = config.get("frame_height", 480)
     fps = config.get("fps", 30)
+    grayscale = config.get("grayscale", True)
+    roi = config.get("roi")
 
     if camera_type == "pi":
         if not PICAMERA2_AVAILABLE:
             raise RuntimeError("picamera2 not installed. Run: sudo apt install python3-picamera2")
-        return PiCamera(width=width, height=height, fps=fps)
+        return PiCamera(width=width, height=height, fps=fps, grayscale=grayscale, roi=roi)
     else:
         return USBCamera(
             index=config.get("camera_index", 0),
             width=width,
             height=height,
-            fps=fps
+            fps=fps,
+            grayscale=grayscale,
+            roi=roi
         )
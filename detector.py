@@ -5,9 +5,15 @@ Detects vehicles approaching a blind corner and triggers an LED alert.
 """
 
 import cv2
+import numpy as np
+import os
 import time
 import json
+import queue
+import signal
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from led_controller import LEDController
@@ -20,17 +26,65 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Motion gate divides the frame into a GATE_TILES x GATE_TILES grid
+GATE_TILES = 8
+
+# detect_motion's result when nothing is found: no [x, y, w, h, area] rows
+NO_BOXES = np.empty((0, 5), np.int32)
+
 
 class VehicleDetector:
     def __init__(self, config_path: str = "config.json"):
         self.config = self._load_config(config_path)
+
+        # Let OpenCV split its own kernels (morphology, resize, ...) into row
+        # strips across every core; it releases the GIL while doing so
+        cv2.setNumThreads(self.config.get("num_threads") or os.cpu_count() or 1)
+
         self.led = LEDController(self.config["led_pin"])
         self.camera = None
-        self.bg_subtractor = cv2.createBackgroundSubtractorMOG2(
-            history=self.config["bg_history"],
-            varThreshold=self.config["var_threshold"],
-            detectShadows=True
-        )
+        self._frames = queue.Queue(maxsize=1)
+        self._stop_capture = threading.Event()
+        self._capture_thread = None
+        self._capture_error = None
+        self._detect_shadows = self.config.get("detect_shadows", False)
+
+        # Only every Nth frame is run through detection. MOG2's history is
+        # counted in processed frames, so shrink it to cover the same time.
+        self._frame_skip = max(1, self.config.get("detect_every_n_frames", 2))
+        self._frame_count = 0
+        self._bg_history = max(1, self.config["bg_history"] // self._frame_skip)
+        self._morph_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+        self._use_cuda = self._select_backend() == "cuda"
+        self.bg_subtractor = self._create_bg_subtractor()
+
+        # Motion is detected on a downscaled frame; areas shrink by scale^2
+        self._detect_scale = self.config.get("detect_scale", 0.5)
+        self._min_area = self.config["min_contour_area"] * self._detect_scale ** 2
+
+        # Background model persistence needs a path OpenCV can write as an image
+        self._bg_model_path = self.config.get("bg_model_path")
+        if self._bg_model_path and not cv2.haveImageWriter(self._bg_model_path):
+            logger.warning(
+                f"bg_model_path {self._bg_model_path} is not an image format OpenCV "
+                "can write (use e.g. .png), background model will not be saved"
+            )
+            self._bg_model_path = None
+        self._bg_seed = self._load_background()
+
+        # Frame-difference gate that skips MOG2 while the scene is idle
+        self._gate_threshold = self.config.get("motion_gate_threshold", 3.0)
+        self._gate_interval = self.config.get("motion_gate_interval", 10)
+        self._gate_learning_rate = min(1.0, self._gate_interval / self._bg_history)
+        self._prev_gray = None
+        self._idle_frames = 0
+
+        # Working buffers reused across frames, sized on the first frame
+        self._buffer_shape = None
+
+        # JPEG encoding and disk writes happen off the detection loop
+        self._io_executor = ThreadPoolExecutor(max_workers=1)
+
         self.last_detection_time = 0
         self.detection_log = []
 
@@ -51,15 +105,129 @@ class VehicleDetector:
             "frame_width": 640,
             "frame_height": 480,
             "fps": 30,
+            "grayscale": True,
+            "num_threads": None,  # OpenCV worker threads; None = all cores
             "led_pin": 17,
             "min_contour_area": 5000,
+            "detect_scale": 0.5,
+            "detect_every_n_frames": 2,
             "detection_cooldown": 2.0,
             "alert_duration": 5.0,
             "bg_history": 500,
+            "bg_model_path": "bg_model.png",
+            "bg_model_max_age": 3600,
             "var_threshold": 50,
+            "detect_shadows": False,
+            "backend": "cpu",
+            "motion_gate_threshold": 3.0,
+            "motion_gate_interval": 10,
             "roi": None,  # Region of interest: [x, y, width, height]
             "save_detections": False,
-            "detections_dir": "detections"
+            "detections_dir": "detections",
+            "jpeg_quality": 85
+        }
+
+    def _select_backend(self) -> str:
+        """Pick "cuda" if requested and a CUDA device is present, else "cpu"."""
+        backend = self.config.get("backend", "cpu")
+        if backend != "cuda":
+            return "cpu"
+        try:
+            if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+                logger.info("Using CUDA backend for background subtraction")
+                return "cuda"
+        except (AttributeError, cv2.error):
+            pass
+        logger.warning("CUDA backend requested but no CUDA device available, using CPU")
+        return "cpu"
+
+    def _create_bg_subtractor(self):
+        """Create the MOG2 background subtractor for the selected backend."""
+        if not self._use_cuda:
+            return cv2.createBackgroundSubtractorMOG2(
+                history=self._bg_history,
+                varThreshold=self.config["var_threshold"],
+                detectShadows=self._detect_shadows
+            )
+
+        # Same dilate -> erode x2 -> dilate chain as the CPU path, on the GPU
+        self._cuda_stream = cv2.cuda.Stream_Null()
+        self._gpu_gray = cv2.cuda_GpuMat()
+        self._cuda_morph = [
+            cv2.cuda.createMorphologyFilter(cv2.MORPH_DILATE, cv2.CV_8UC1, self._morph_kernel),
+            cv2.cuda.createMorphologyFilter(
+                cv2.MORPH_ERODE, cv2.CV_8UC1, self._morph_kernel, iterations=2
+            ),
+            cv2.cuda.createMorphologyFilter(cv2.MORPH_DILATE, cv2.CV_8UC1, self._morph_kernel),
+        ]
+        return cv2.cuda.createBackgroundSubtractorMOG2(
+            history=self._bg_history,
+            varThreshold=self.config["var_threshold"],
+            detectShadows=self._detect_shadows
+        )
+
+    def _load_background(self):
+        """
+        Load the background image saved at the last shutdown, if it is
+        recent enough to describe the current scene. Returns None otherwise.
+        """
+        path = self._bg_model_path
+        if not path or not Path(path).exists():
+            return None
+
+        age = time.time() - Path(path).stat().st_mtime
+        if age > self.config.get("bg_model_max_age", 3600):
+            logger.info(f"Saved background model is {age:.0f}s old, ignoring")
+            return None
+
+        # Same image size is not enough: a moved ROI or different scale
+        # would seed the model with the wrong view of the scene
+        meta_path = Path(path).with_suffix(".json")
+        try:
+            with open(meta_path) as f:
+                saved_view = json.load(f)
+        except (OSError, ValueError):
+            saved_view = None
+        if saved_view != self._background_view():
+            logger.info("Saved background model was taken with a different camera view, ignoring")
+            return None
+
+        background = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if background is None:
+            logger.warning(f"Could not read saved background model {path}")
+        return background
+
+    def _save_background(self):
+        """Save MOG2's current background image for the next startup."""
+        path = self._bg_model_path
+        if not path:
+            return
+
+        try:
+            if self._use_cuda:
+                background = self.bg_subtractor.getBackgroundImage(self._cuda_stream).download()
+            else:
+                background = self.bg_subtractor.getBackgroundImage()
+            if background is None or background.size == 0:
+                return
+
+            if not cv2.imwrite(path, background):
+                logger.error(f"Failed to save background model: {path}")
+                return
+            with open(Path(path).with_suffix(".json"), "w") as f:
+                json.dump(self._background_view(), f)
+            logger.info(f"Saved background model: {path}")
+        except Exception:
+            # Runs during shutdown; a failed save must not skip the rest of it
+            logger.exception(f"Failed to save background model: {path}")
+
+    def _background_view(self) -> dict:
+        """Camera view settings a saved background image is only valid for."""
+        return {
+            "frame_width": self.config.get("frame_width", 640),
+            "frame_height": self.config.get("frame_height", 480),
+            "roi": self.config.get("roi"),
+            "detect_scale": self._detect_scale,
         }
 
     def start_camera(self):
@@ -67,57 +235,204 @@ class VehicleDetector:
         self.camera = create_camera(self.config)
         self.camera.start()
 
+        # Capture on its own thread so reads overlap with detection
+        self._stop_capture.clear()
+        self._capture_error = None
+        self._capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+        self._capture_thread.start()
+
     def stop_camera(self):
         """Release the camera."""
+        self._stop_capture.set()
+        if self._capture_thread:
+            self._capture_thread.join(timeout=1.0)
         if self.camera:
             self.camera.release()
 
+    def _capture_loop(self):
+        """
+        Read frames continuously, keeping only the newest one queued.
+        An exception ends the thread and is kept for run() to re-raise.
+        """
+        try:
+            while not self._stop_capture.is_set():
+                ret, frame = self.camera.read()
+                if not ret:
+                    logger.error("Failed to read frame")
+                    continue
+
+                try:
+                    self._frames.put_nowait(frame)
+                except queue.Full:
+                    # Detection is behind - replace the stale frame
+                    try:
+                        self.camera.recycle(self._frames.get_nowait())
+                    except queue.Empty:
+                        pass
+                    self._frames.put_nowait(frame)
+        except Exception as e:
+            logger.exception("Camera capture failed")
+            self._capture_error = e
+
     def detect_motion(self, frame) -> tuple:
         """
         Detect motion in frame using background subtraction.
-        Returns (detected: bool, contours: list)
+        Returns (detected: bool, boxes: array of [x, y, w, h, area] rows
+        in downscaled detection coordinates)
+
+        The whole chain stays 8-bit: the gray, diff and mask buffers are
+        uint8 so MOG2 takes its CV_8U path, and only the gate's integral
+        image is wider (int32).
         """
-        # Apply region of interest if configured
-        roi = self.config.get("roi")
-        if roi:
-            x, y, w, h = roi
-            frame = frame[y:y+h, x:x+w]
-
-        # Convert to grayscale and blur
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (21, 21), 0)
-
-        # Apply background subtraction
-        fg_mask = self.bg_subtractor.apply(blurred)
-
-        # Remove shadows (marked as gray in MOG2)
-        _, fg_mask = cv2.threshold(fg_mask, 250, 255, cv2.THRESH_BINARY)
-
-        # Morphological operations to clean up
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-        fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_CLOSE, kernel)
-        fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_OPEN, kernel)
-
-        # Find contours
-        contours, _ = cv2.findContours(
-            fg_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+        assert frame.dtype == np.uint8, f"expected uint8 frame, got {frame.dtype}"
+
+        # Frames arrive already cropped to the ROI by the camera layer.
+        # Every OpenCV call below writes into a preallocated buffer (dst=)
+        # so the per-frame path allocates no new arrays.
+        if frame.shape != self._buffer_shape:
+            self._allocate_buffers(frame.shape)
+
+        # Convert to grayscale (unless the camera already delivers it) and
+        # downscale, into whichever gray buffer isn't holding the previous frame
+        gray = self._gray_bufs[1] if self._prev_gray is self._gray_bufs[0] else self._gray_bufs[0]
+        if self._detect_scale == 1.0:
+            if frame.ndim == 2:
+                # Copy rather than alias: the camera reuses frame buffers
+                np.copyto(gray, frame)
+            else:
+                cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+        else:
+            if frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray_full)
+            cv2.resize(frame, self._detect_size, dst=gray, interpolation=cv2.INTER_AREA)
+
+        # Warm-start MOG2 from the saved background: OpenCV only persists
+        # MOG2's parameters, not its per-pixel mixtures, so rebuild them by
+        # feeding the saved image for a full history
+        if self._bg_seed is not None:
+            if self._bg_seed.shape == gray.shape:
+                for _ in range(self._bg_history):
+                    self._update_background(self._bg_seed)
+                logger.info("Background model restored from previous run")
+            self._bg_seed = None
+
+        # Skip the full pipeline while nothing is changing, but still feed
+        # MOG2 every motion_gate_interval frames. Gradual changes (clouds,
+        # dusk) never trip the gate, so each idle update learns
+        # motion_gate_interval frames' worth to keep pace in wall-clock time.
+        if self._gate_threshold and not self._frame_changed(gray):
+            self._idle_frames += 1
+            if self._idle_frames % self._gate_interval == 0:
+                self._update_background(gray, self._gate_learning_rate)
+            return False, NO_BOXES
+        self._idle_frames = 0
+
+        fg_mask = self._foreground_mask(gray)
+
+        # Label blobs and get their bounding boxes and areas in one call;
+        # row 0 of stats is the background
+        _, _, stats, _ = cv2.connectedComponentsWithStats(
+            fg_mask, labels=self._labels, connectivity=8
         )
 
         # Filter by minimum area
-        significant_contours = [
-            c for c in contours
-            if cv2.contourArea(c) > self.config["min_contour_area"]
-        ]
+        boxes = stats[1:][stats[1:, cv2.CC_STAT_AREA] > self._min_area]
+
+        return len(boxes) > 0, boxes
+
+    def _update_background(self, gray, learning_rate: float = -1):
+        """
+        Feed a frame to MOG2 for its model update only.
+        A learning_rate of -1 lets MOG2 pick its own from the history.
+        """
+        if self._use_cuda:
+            self._gpu_gray.upload(gray)
+            self.bg_subtractor.apply(self._gpu_gray, learning_rate, self._cuda_stream)
+        else:
+            self.bg_subtractor.apply(gray, fgmask=self._fg_mask, learningRate=learning_rate)
+
+    def _foreground_mask(self, gray):
+        """Background-subtract gray and clean up the mask for labelling."""
+        if self._use_cuda:
+            # Only the small binary mask comes back from the GPU
+            self._gpu_gray.upload(gray)
+            gpu_mask = self.bg_subtractor.apply(self._gpu_gray, -1, self._cuda_stream)
+            if self._detect_shadows:
+                _, gpu_mask = cv2.cuda.threshold(gpu_mask, 250, 255, cv2.THRESH_BINARY)
+            for morph in self._cuda_morph:
+                gpu_mask = morph.apply(gpu_mask)
+            return gpu_mask.download(self._mask_tmp)
+
+        # Apply background subtraction. No pre-blur: MOG2 models per-pixel
+        # noise itself, and the opening below removes residual speckle.
+        fg_mask = self.bg_subtractor.apply(gray, fgmask=self._fg_mask)
+
+        # Remove shadows (marked as gray in MOG2); without shadow
+        # detection the mask is already strictly 0/255
+        if self._detect_shadows:
+            cv2.threshold(fg_mask, 250, 255, cv2.THRESH_BINARY, dst=fg_mask)
+
+        # Morphological close then open, as one dilate -> erode x2 -> dilate
+        # chain ping-ponging between the two mask buffers
+        cv2.dilate(fg_mask, self._morph_kernel, dst=self._mask_tmp)
+        cv2.erode(self._mask_tmp, self._morph_kernel, dst=fg_mask, iterations=2)
+        return cv2.dilate(fg_mask, self._morph_kernel, dst=self._mask_tmp)
+
+    def _allocate_buffers(self, frame_shape):
+        """Size the reusable per-frame working buffers for frame_shape."""
+        h, w = frame_shape[:2]
+        small_h = max(1, round(h * self._detect_scale))
+        small_w = max(1, round(w * self._detect_scale))
+
+        self._buffer_shape = frame_shape
+        self._detect_size = (small_w, small_h)
+        self._gray_full = np.empty((h, w), np.uint8)
+        self._gray_bufs = [np.empty((small_h, small_w), np.uint8) for _ in range(2)]
+        self._prev_gray = None
+        self._diff = np.empty((small_h, small_w), np.uint8)
+        self._integral = np.empty((small_h + 1, small_w + 1), np.int32)
+        self._fg_mask = np.empty((small_h, small_w), np.uint8)
+        self._mask_tmp = np.empty((small_h, small_w), np.uint8)
+        self._labels = np.empty((small_h, small_w), np.int32)
+        self._gate_edges = (
+            np.linspace(0, small_h, GATE_TILES + 1).astype(int),
+            np.linspace(0, small_w, GATE_TILES + 1).astype(int),
+        )
 
-        return len(significant_contours) > 0, significant_contours
+    def _frame_changed(self, gray) -> bool:
+        """
+        Cheap pre-gate: compare against the previous frame tile by tile.
+        Returns True if any tile's mean absolute difference exceeds
+        motion_gate_threshold.
+        """
+        prev, self._prev_gray = self._prev_gray, gray
+        if prev is None:
+            return True
+
+        h, w = gray.shape
+        ys, xs = self._gate_edges
+
+        # Per-tile sums of |gray - prev| from the integral image
+        cv2.absdiff(gray, prev, dst=self._diff)
+        integral = cv2.integral(self._diff, sum=self._integral)
+        tile_sums = (
+            integral[np.ix_(ys[1:], xs[1:])] - integral[np.ix_(ys[:-1], xs[1:])]
+            - integral[np.ix_(ys[1:], xs[:-1])] + integral[np.ix_(ys[:-1], xs[:-1])]
+        )
+        tile_area = (h / GATE_TILES) * (w / GATE_TILES)
+        return tile_sums.max() > self._gate_threshold * tile_area
 
-    def handle_detection(self, frame, contours):
-        """Handle a positive detection."""
+    def handle_detection(self, frame, boxes) -> bool:
+        """
+        Handle a positive detection.
+        Returns True if the frame was handed to the image writer, which
+        then owns it and recycles it once saved.
+        """
         current_time = time.time()
 
         # Check cooldown
         if current_time - self.last_detection_time < self.config["detection_cooldown"]:
-            return
+            return False
 
         self.last_detection_time = current_time
         timestamp = datetime.now().isoformat()
@@ -130,28 +445,45 @@ class VehicleDetector:
         # Log detection
         self.detection_log.append({
             "timestamp": timestamp,
-            "contour_count": len(contours)
+            "contour_count": len(boxes)
         })
 
-        # Optionally save detection image
+        # Optionally save detection image. Ownership of the frame buffer
+        # passes to the writer, so no copy is needed.
         if self.config.get("save_detections"):
-            self._save_detection(frame, contours, timestamp)
-
-    def _save_detection(self, frame, contours, timestamp):
-        """Save detection image with bounding boxes."""
-        detections_dir = Path(self.config["detections_dir"])
-        detections_dir.mkdir(exist_ok=True)
+            self._io_executor.submit(self._save_detection, frame, boxes, timestamp)
+            return True
+        return False
 
-        # Draw bounding boxes
-        frame_copy = frame.copy()
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            cv2.rectangle(frame_copy, (x, y), (x+w, y+h), (0, 255, 0), 2)
-
-        # Save image
-        filename = detections_dir / f"detection_{timestamp.replace(':', '-')}.jpg"
-        cv2.imwrite(str(filename), frame_copy)
-        logger.info(f"Saved detection image: {filename}")
+    def _save_detection(self, frame, boxes, timestamp):
+        """
+        Save detection image with bounding boxes.
+        Runs on the I/O executor, draws on the owned frame in place and
+        recycles it to the camera when done.
+        """
+        try:
+            detections_dir = Path(self.config["detections_dir"])
+            detections_dir.mkdir(exist_ok=True)
+
+            # Draw bounding boxes (in color, even on a grayscale capture)
+            image = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR) if frame.ndim == 2 else frame
+            for box in boxes:
+                # Boxes are in downscaled detection coordinates
+                x, y, w, h = (int(v / self._detect_scale) for v in box[:4])
+                cv2.rectangle(image, (x, y), (x+w, y+h), (0, 255, 0), 2)
+
+            # Save image
+            filename = detections_dir / f"detection_{timestamp.replace(':', '-')}.jpg"
+            quality = self.config.get("jpeg_quality", 85)
+            if cv2.imwrite(str(filename), image, [int(cv2.IMWRITE_JPEG_QUALITY), quality]):
+                logger.info(f"Saved detection image: {filename}")
+            else:
+                logger.error(f"Failed to save detection image: {filename}")
+        except Exception:
+            # Runs on the executor, whose Future nobody waits on
+            logger.exception(f"Failed to save detection image for {timestamp}")
+        finally:
+            self.camera.recycle(frame)
 
     def run(self):
         """Main detection loop."""
@@ -160,27 +492,44 @@ class VehicleDetector:
 
         try:
             while True:
-                ret, frame = self.camera.read()
-                if not ret:
-                    logger.error("Failed to read frame")
+                try:
+                    frame = self._frames.get(timeout=1.0)
+                except queue.Empty:
+                    # A dead capture thread will never deliver another frame;
+                    # exit so the service manager can restart us
+                    if not self._capture_thread.is_alive():
+                        raise RuntimeError("Camera capture thread stopped") from self._capture_error
+                    logger.error("No frame received from camera")
                     continue
 
-                detected, contours = self.detect_motion(frame)
+                self._frame_count += 1
+                if self._frame_count % self._frame_skip == 0:
+                    detected, boxes = self.detect_motion(frame)
 
-                if detected:
-                    self.handle_detection(frame, contours)
+                    if detected and self.handle_detection(frame, boxes):
+                        continue  # The image writer recycles this frame
 
-                # Small delay to reduce CPU usage
-                time.sleep(0.033)  # ~30 FPS
+                # Hand the buffer back for reuse by the camera
+                self.camera.recycle(frame)
 
         except KeyboardInterrupt:
             logger.info("Shutting down...")
         finally:
             self.stop_camera()
+            self._io_executor.shutdown(wait=True)
             self.led.cleanup()
+            self._save_background()
+
+
+def _handle_sigterm(signum, frame):
+    """Turn SIGTERM (systemctl stop/restart) into the Ctrl-C shutdown path."""
+    raise KeyboardInterrupt
 
 
 def main():
+    # Without a handler SIGTERM exits without running run()'s cleanup,
+    # losing the saved background model and pending detection images
+    signal.signal(signal.SIGTERM, _handle_sigterm)
     detector = VehicleDetector()
     detector.run()
 
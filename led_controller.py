@@ -69,14 +69,15 @@ class LEDController:
         self.gpio.output(self.pin, self.gpio.LOW)
 
     def blink(self, times: int = 3, interval: float = 0.3):
-        """Blink the LED."""
+        """Blink the LED. Returns early if the alert is stopped."""
         for _ in range(times):
-            if self._stop_alert.is_set():
-                break
             self.on()
-            time.sleep(interval)
+            if self._stop_alert.wait(timeout=interval):
+                break
             self.off()
-            time.sleep(interval)
+            if self._stop_alert.wait(timeout=interval):
+                break
+        self.off()
 
     def alert(self, duration: float = 5.0, pattern: str = "solid"):
         """
@@ -94,18 +95,23 @@ class LEDController:
         self._stop_alert.clear()
 
         def _run_alert():
-            start_time = time.time()
             if pattern == "blink":
-                while time.time() - start_time < duration:
-                    if self._stop_alert.is_set():
+                interval = 0.2
+                deadline = time.monotonic() + duration
+                lit = False
+                while not self._stop_alert.is_set():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
                         break
-                    self.blink(times=1, interval=0.2)
+                    lit = not lit
+                    if lit:
+                        self.on()
+                    else:
+                        self.off()
+                    self._stop_alert.wait(timeout=min(interval, remaining))
             else:  # solid
                 self.on()
-                while time.time() - start_time < duration:
-                    if self._stop_alert.is_set():
-                        break
-                    time.sleep(0.1)
+                self._stop_alert.wait(timeout=duration)
             self.off()
 
         self._alert_thread = threading.Thread(target=_run_alert, daemon=True)